@@ -1,16 +1,50 @@
 #!/usr/bin/env python3
 import argparse
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import asyncio
+import dbm
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+import heapq
 import ipaddress
+import itertools
 import math
-import platform
+import multiprocessing
+import multiprocessing.connection
+from operator import attrgetter
+import os
+import queue
 import requests
+from requests.adapters import HTTPAdapter
+import shelve
 import socket
-import subprocess
+import struct
 import sys
 import threading
 import time
-from typing import Optional
+from typing import Callable, Optional
+
+try:
+    # Optional: a faster drop-in event loop built on libuv (not available on Windows)
+    import uvloop
+except ImportError:
+    uvloop = None
+
+try:
+    # Not available on Windows
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    # Optional: offline IP geolocation from a local MaxMind GeoLite2 database
+    import geoip2.database
+    import geoip2.errors
+except ImportError:
+    geoip2 = None
+
+# Reuse keep-alive connections to ipinfo.io across location lookups instead of a new TLS handshake each time
+_geo_session = requests.Session()
+_geo_session.mount("https://", HTTPAdapter(pool_connections=8, pool_maxsize=32, max_retries=1))
 
 
 # --- ANSI Escape Codes for Formatting ---
@@ -31,6 +65,52 @@ class Ansi:
     CLEAR_SCREEN_FROM_CURSOR = "\033[J"
 
 
+@dataclass(slots=True)
+class Result:
+    """A tested IP address with its average latency and, once looked up, its location."""
+    ip: str
+    latency: float
+    location: Optional[str] = None
+
+
+class TopResults:
+    """
+    Keeps the `limit` lowest-latency results seen so far, ignoring latencies at or above max_latency.
+    Used both for the overall ranking and for each shard's own ranking when scanning in several processes.
+    """
+
+    def __init__(self, limit: int, max_latency: Optional[int]=None):
+        self.limit = limit
+        self.max_latency = max_latency
+        self._heap = []  # Max-heap of (-latency, tie breaker, item)
+        self._tie_breaker = itertools.count()
+
+    def accepts(self, latency: Optional[float]) -> bool:
+        """Whether a result with this latency would make it into the top list."""
+        if latency is None or (self.max_latency is not None and latency >= self.max_latency):
+            return False
+        return len(self._heap) < self.limit or -latency > self._heap[0][0]
+
+    def add(self, latency: float, item=None) -> None:
+        """Adds an accepted result, evicting the slowest one if the list is full."""
+        entry = (-latency, next(self._tie_breaker), item)
+        if len(self._heap) < self.limit:
+            heapq.heappush(self._heap, entry)
+        else:
+            heapq.heapreplace(self._heap, entry)
+
+    def worst_allowed(self) -> float:
+        """The first-try latency above which an IP is not worth pinging again."""
+        if len(self._heap) < self.limit:
+            return math.inf
+        # Leave some slack since the first try alone is a noisy estimate of the average
+        return -self._heap[0][0] * 1.3
+
+    def items(self) -> list:
+        """The items in the top list, from the lowest latency to the highest."""
+        return [item for _, _, item in sorted(self._heap, reverse=True)]
+
+
 def get_cloudflare_ips() -> Optional[list[str]]:
     """
     Fetches the list of Cloudflare IPv4 CIDR ranges from their official API.
@@ -55,30 +135,142 @@ def expand_cidrs(cidrs: list[str]) -> list[str]:
     Expands a list of CIDR ranges into a list of individual IP addresses.
     For small blocks (>= 24 fixed bits), it tests all IPs.
     For larger blocks, it tests only IPs with the last 4 bits 0.
+
+    Addresses are expanded as integers, and only formatted as strings at the end.
+    Deduplication is skipped when the ranges do not overlap, which holds for Cloudflare's published list.
     """
-    ips = []
+    nets = []
     for cidr in cidrs:
         try:
-            net = ipaddress.ip_network(cidr)
-            # Cloudflare network addresses also respond to pings, so we include them
-            if net.prefixlen >= 24:
-                ips.extend([str(ip) for ip in net])
-            else:
-                for ip_obj in net:
-                    if int(ip_obj) % 16 == 0:
-                        ips.append(str(ip_obj))
+            nets.append(ipaddress.IPv4Network(cidr))
         except ValueError as e:
             print(f"{Ansi.YELLOW}Warning: Could not parse CIDR {cidr}: {e}{Ansi.ENDC}")
-    return list(set(ips))
+    nets.sort(key=attrgetter("network_address"))
+
+    # Cloudflare network addresses also respond to pings, so we include them
+    ips = itertools.chain.from_iterable(
+        range(int(net.network_address), int(net.broadcast_address) + 1, 1 if net.prefixlen >= 24 else 16)
+        for net in nets)
+    if any(prev.broadcast_address >= net.network_address for prev, net in zip(nets, nets[1:])):
+        ips = set(ips)
+
+    # Formatting the octets directly is much faster than going through IPv4Address objects
+    return [f"{(ip >> 24) & 0xff}.{(ip >> 16) & 0xff}.{(ip >> 8) & 0xff}.{ip & 0xff}" for ip in ips]
+
+
+def open_geoip_db(path: str) -> Optional["geoip2.database.Reader"]:
+    """
+    Opens a local MaxMind GeoLite2-City database for offline location lookups.
+    Returns None if the database file or the geoip2 library is not available, or the database is not a City database.
+    """
+    path = os.path.expanduser(path)
+    if not os.path.isfile(path):
+        return None
+    if geoip2 is None:
+        print(f"{Ansi.YELLOW}Warning: Found {path} but geoip2 is not installed, using ipinfo.io instead.{Ansi.ENDC}")
+        return None
+    try:
+        reader = geoip2.database.Reader(path)
+    except (OSError, ValueError, RuntimeError) as e:  # A corrupt file raises maxminddb.InvalidDatabaseError (a RuntimeError)
+        print(f"{Ansi.YELLOW}Warning: Could not open GeoIP database {path}: {e}{Ansi.ENDC}")
+        return None
+
+    # Only City databases support Reader.city, e.g. a GeoLite2-Country database would raise TypeError
+    database_type = reader.metadata().database_type
+    if "City" not in database_type:
+        reader.close()
+        print(f"{Ansi.YELLOW}Warning: {path} is a {database_type} database, not a City database, "
+              f"using ipinfo.io instead.{Ansi.ENDC}")
+        return None
+    return reader
+
+
+# Cached locations expire after a day
+LOCATION_CACHE_TTL = 24 * 60 * 60
+
+
+class LocationCache:
+    """
+    A persistent on-disk cache of IP locations shared between runs.
+
+    Cloudflare IPs in the same /24 block are served from the same location, so entries are keyed by
+    the /24 prefix and expire after LOCATION_CACHE_TTL seconds.
+    Must only be used from the thread that opened it, since the dbm.sqlite3 backend that shelve uses
+    from Python 3.13 cannot be shared between threads.
+    """
+    def __init__(self, path: str):
+        path = os.path.expanduser(path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = shelve.open(path)
+
+    @staticmethod
+    def _key(ip: str) -> str:
+        return ip.rsplit(".", 1)[0]
+
+    def get(self, ip: str) -> Optional[str]:
+        """Returns the cached location of the IP's /24 block, or None if it is missing or expired."""
+        entry = self._db.get(self._key(ip))
+        if entry is None or time.time() - entry["t"] >= LOCATION_CACHE_TTL:
+            return None
+        return entry["loc"]
+
+    def set(self, ip: str, location: str) -> None:
+        self._db[self._key(ip)] = {"loc": location, "t": time.time()}
+
+    def close(self) -> None:
+        self._db.close()
 
 
-def get_ip_location(ip: str) -> str:
+def open_location_cache(path: str) -> Optional[LocationCache]:
+    """Opens the on-disk location cache. Returns None if it cannot be opened."""
+    try:
+        return LocationCache(path)
+    except dbm.error as e:
+        print(f"{Ansi.YELLOW}Warning: Could not open location cache {path}: {e}{Ansi.ENDC}")
+        return None
+
+
+def get_ip_locations_batch(ips: list[str], token: str) -> dict[str, str]:
     """
-    Fetches the physical location of an IP address using ipinfo.io,
-    which is more reliable in China.
+    Fetches the physical locations of up to 100 IP addresses with a single ipinfo.io batch request.
+    Returns a dict mapping each IP to its location. The batch endpoint requires an ipinfo.io token.
+    """
+    locations = {}
+    try:
+        response = _geo_session.post("https://ipinfo.io/batch", json=ips,
+                                     headers={"Authorization": f"Bearer {token}"}, timeout=10)
+        response.raise_for_status()
+        data = response.json()
+    except requests.exceptions.RequestException:
+        data = {}
+    if not isinstance(data, dict):
+        data = {}
+
+    for ip in ips:
+        info = data.get(ip)
+        if not isinstance(info, dict):
+            locations[ip] = "Network Error"
+            continue
+        locations[ip] = f"{info.get('city', 'N/A')}, {info.get('country', 'N/A')}"
+    return locations
+
+
+def get_ip_location(ip: str, geoip_reader: Optional["geoip2.database.Reader"]=None) -> str:
+    """
+    Fetches the physical location of an IP address.
+
+    Uses the local GeoLite2 database if a reader is given, which needs no network access.
+    Otherwise falls back to ipinfo.io, which is more reliable in China.
     """
+    if geoip_reader is not None:
+        try:
+            response = geoip_reader.city(ip)
+        except (geoip2.errors.AddressNotFoundError, ValueError):
+            return "N/A, N/A"
+        return f"{response.city.name or 'N/A'}, {response.country.iso_code or 'N/A'}"
+
     try:
-        response = requests.get(f"https://ipinfo.io/{ip}/json", timeout=10)
+        response = _geo_session.get(f"https://ipinfo.io/{ip}/json", timeout=10)
         response.raise_for_status()
         data = response.json()
         city = data.get("city", "N/A")
@@ -88,37 +280,308 @@ def get_ip_location(ip: str) -> str:
         return "Network Error"
 
 
-def ping_ip(ip: str, n_tries: int=4, timeout: float=1.0) -> Optional[float]:
+# struct linger {l_onoff=1, l_linger=0}: reset the connection on close instead of a graceful FIN,
+# so no TIME_WAIT sockets pile up. Windows uses two u_shorts, other platforms two ints.
+LINGER_RESET = struct.pack("HH" if sys.platform == "win32" else "ii", 1, 0)
+# Socket options applied to every ping socket, resolved once instead of for every try
+PING_SOCKET_OPTIONS = [
+    (socket.SOL_SOCKET, socket.SO_LINGER, LINGER_RESET),
+    (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+]
+# Best-effort socket options, skipped if the kernel rejects them
+OPTIONAL_PING_SOCKET_OPTIONS = []
+if hasattr(socket, "TCP_QUICKACK"):  # Linux only
+    OPTIONAL_PING_SOCKET_OPTIONS.append((socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1))
+
+
+def make_ping_socket() -> socket.socket:
+    """
+    Creates a non-blocking TCP socket configured for a single ping.
+    A connected TCP socket cannot connect again, so every try needs a fresh socket.
+    """
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        s.setblocking(False)
+        for level, option, value in PING_SOCKET_OPTIONS:
+            s.setsockopt(level, option, value)
+        for level, option, value in OPTIONAL_PING_SOCKET_OPTIONS:
+            try:
+                s.setsockopt(level, option, value)
+            except OSError:
+                pass
+    except BaseException:
+        s.close()
+        raise
+    return s
+
+
+async def tcp_ping(
+        ip: str, n_tries: int=4, timeout: float=1.0,
+        worst_allowed: Optional[Callable[[], float]]=None) -> Optional[float]:
     """
     Pings a single IP address multiple times and returns the average latency.
     Returns None if the ping fails or times out.
 
-    The ping command uses the TCP protocol to connect to the 443 port of the target IP.
+    The ping uses the TCP protocol to connect to the 443 port of the target IP.
+    The latency is measured when the coroutine resumes, so it includes any time the connection waited
+    for the busy event loop. The more pings run concurrently, the larger this error.
+    If worst_allowed is given, it is called after the first try and the ping is abandoned (returns None)
+    if that try was slower than the returned latency, saving the remaining tries for hopeless IPs.
 
     Note: n_tries must be at least 1. 3 is the recommended minimum.
     """
+    loop = asyncio.get_running_loop()
     latencies = []
 
     for _ in range(n_tries):
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.settimeout(timeout)
-
-        start_time = time.perf_counter()
+        s = make_ping_socket()
+        # asyncio.wait_for is not used since before Python 3.12 it can swallow a cancellation (e.g. Ctrl-C)
+        # that arrives just as the connection completes, which would keep the worker pinging
+        connect = asyncio.ensure_future(loop.sock_connect(s, (ip, 443)))
         try:
-            if s.connect_ex((ip, 443)) == 0:
-                end_time = time.perf_counter()
-                s.shutdown(socket.SHUT_RDWR)
-                latencies.append((end_time - start_time) * 1000)
-            else:
+            start_time = time.perf_counter()
+            done, _ = await asyncio.wait({connect}, timeout=timeout)
+            end_time = time.perf_counter()
+            if not done or connect.exception() is not None:
                 return None
-        except socket.error:
-            return None
+            latencies.append((end_time - start_time) * 1000)
         finally:
+            if not connect.done():
+                connect.cancel()
+                # Let the connect remove the socket from the event loop before the socket is closed
+                await asyncio.wait({connect})
             s.close()
 
+        if worst_allowed is not None and len(latencies) == 1 and latencies[0] > worst_allowed():
+            return None
+
     return sum(latencies) / len(latencies)
 
 
+async def ping_ips(
+        ips: list[str], concurrency: int, on_result: Callable[[str, Optional[float]], None],
+        worst_allowed: Optional[Callable[[], float]]=None) -> None:
+    """
+    Pings all IPs and calls on_result(ip, latency) as each ping finishes.
+
+    A fixed number of workers pull IPs from a shared iterator, so only `concurrency` pings
+    exist at any time instead of one pending task per IP. No more workers are started than there are IPs.
+    """
+    ip_iter = iter(ips)
+
+    async def probe_worker():
+        """Pings IPs one after another until there are none left."""
+        for ip in ip_iter:
+            try:
+                latency = await tcp_ping(ip, worst_allowed=worst_allowed)
+            except Exception:
+                latency = None
+            on_result(ip, latency)
+
+    await asyncio.gather(*(probe_worker() for _ in range(min(concurrency, len(ips)))))
+
+
+def run_event_loop(coro):
+    """Runs the coroutine to completion on uvloop if it is installed, otherwise on the default event loop."""
+    if uvloop is not None and hasattr(uvloop, "run"):
+        return uvloop.run(coro)
+    if uvloop is not None:
+        # uvloop.run only exists from uvloop 0.18, older versions (e.g. distro packages) need the loop policy
+        uvloop.install()
+    return asyncio.run(coro)
+
+
+# Queue for sending ping results from a shard worker process back to the main process
+_shard_queue = None
+
+
+def _init_shard_worker(shard_queue: "multiprocessing.Queue") -> None:
+    global _shard_queue
+    _shard_queue = shard_queue
+    # A shard whose main process is gone (e.g. killed with SIGTERM or SIGKILL) has nobody to report to,
+    # so exit instead of scanning the rest of the shard as an orphan
+    threading.Thread(target=_exit_with_parent, daemon=True).start()
+
+
+def _exit_with_parent() -> None:
+    """Waits until the main process has exited, then exits this worker process immediately."""
+    parent = multiprocessing.parent_process()
+    if parent is None:
+        return
+    multiprocessing.connection.wait([parent.sentinel])
+    os._exit(1)
+
+
+def scan_shard(ips: list[str], concurrency: int, limit: int, max_latency: Optional[int]) -> None:
+    """
+    Pings a shard of the IPs in a worker process and keeps the shard's own top list.
+    Sends (tested count, [(ip, latency), ...]) batches to the main process, containing only the results
+    that made it into the shard's top list, since the overall top list is always made up of those.
+    Sends None once the shard is done.
+
+    Pings are abandoned early against the shard's own top list, which is never better than the overall one.
+    """
+    top_results = TopResults(limit, max_latency)
+    tested = 0
+    batch = []
+    last_flush = time.monotonic()
+
+    def on_result(ip, latency):
+        nonlocal tested, last_flush
+        tested += 1
+        if top_results.accepts(latency):
+            top_results.add(latency)
+            batch.append((ip, latency))
+
+        if len(batch) >= 100 or time.monotonic() - last_flush >= 0.1:
+            _shard_queue.put((tested, batch.copy()))
+            tested = 0
+            batch.clear()
+            last_flush = time.monotonic()
+
+    try:
+        run_event_loop(ping_ips(ips, concurrency, on_result, top_results.worst_allowed))
+        if tested:
+            _shard_queue.put((tested, batch))
+    finally:
+        _shard_queue.put(None)
+
+
+async def ping_ips_in_processes(
+        ips: list[str], processes: int, concurrency: int, limit: int, max_latency: Optional[int],
+        on_results: Callable[[int, list[tuple[str, float]]], None]) -> None:
+    """
+    Splits the IPs into one shard per process and pings the shards in parallel worker processes,
+    so that handling ping results is not limited to a single CPU core.
+    Calls on_results(tested count, [(ip, latency), ...]) on the event loop thread as batches arrive,
+    with the number of IPs a shard has tested since its last batch and those of them in the shard's top list.
+    The processes share the concurrency, so there must not be more processes than concurrent pings.
+    """
+    loop = asyncio.get_running_loop()
+    # Spawn fresh worker processes instead of forking this one, which is running an event loop (with its SIGINT
+    # handler) and possibly the location batcher thread. Spawned shards handle Ctrl-C with their own event loop.
+    mp_context = multiprocessing.get_context("spawn")
+    shard_queue = mp_context.Queue()
+    # Split the concurrency exactly, so that the shards together never exceed it
+    shard_concurrencies = [concurrency // processes + (i < concurrency % processes) for i in range(processes)]
+
+    pool = ProcessPoolExecutor(max_workers=processes, mp_context=mp_context,
+                               initializer=_init_shard_worker, initargs=(shard_queue,))
+    shard_futures = [
+        loop.run_in_executor(pool, scan_shard, ips[i::processes], shard_concurrencies[i], limit, max_latency)
+        for i in range(processes)
+    ]
+
+    # Forward results until every shard has reported that it is done.
+    # The shards are watched at the same time, since a shard whose process died never sends its None.
+    running_shards = set(shard_futures)
+    finished_shards = 0
+    get_batch = None
+    try:
+        while finished_shards < processes:
+            if get_batch is None:
+                # Time out regularly so that the waiting thread does not block forever once a shard has failed
+                get_batch = loop.run_in_executor(None, shard_queue.get, True, 0.5)
+            done, _ = await asyncio.wait({get_batch, *running_shards}, return_when=asyncio.FIRST_COMPLETED)
+            for shard_future in done & running_shards:
+                running_shards.remove(shard_future)
+                shard_future.result()  # Raises if the shard failed, e.g. BrokenProcessPool if its process was killed
+            if get_batch not in done:
+                continue
+
+            try:
+                batch = get_batch.result()
+            except queue.Empty:
+                continue
+            finally:
+                get_batch = None
+            if batch is None:
+                finished_shards += 1
+                continue
+            on_results(*batch)
+
+        await asyncio.gather(*shard_futures)
+    finally:
+        # Once a shard has failed, the other futures are abandoned without logging their errors as never retrieved
+        for future in [get_batch, *shard_futures]:
+            if future is None:
+                continue
+            if not future.done():
+                future.cancel()
+            elif not future.cancelled():
+                future.exception()
+        if finished_shards < processes:
+            # Stop the shards that are still pinging after a Ctrl-C or a failure. Otherwise the pool would
+            # be joined at exit, which waits until they finish the rest of the scan.
+            _terminate_workers(pool)
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _terminate_workers(pool: ProcessPoolExecutor) -> None:
+    """Terminates the worker processes of a process pool."""
+    if hasattr(pool, "terminate_workers"):  # Python 3.14+
+        pool.terminate_workers()
+        return
+    for process in list((pool._processes or {}).values()):
+        process.terminate()
+
+
+def limit_concurrency(concurrency: int) -> int:
+    """
+    Limits the number of concurrent pings to 80% of the open file limit, since every ping holds a socket
+    registered with the event loop's selector (epoll/kqueue). Raises the soft limit towards the hard limit first.
+    Returns the concurrency unchanged on platforms without the resource module.
+    """
+    if resource is None:
+        return concurrency
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    needed = math.ceil(concurrency / 0.8)
+    if soft != resource.RLIM_INFINITY and soft < needed:
+        new_soft = needed if hard == resource.RLIM_INFINITY else min(needed, hard)
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (new_soft, hard))
+            soft = new_soft
+        except (ValueError, OSError):
+            pass
+
+    if soft == resource.RLIM_INFINITY:
+        return concurrency
+    return max(1, min(concurrency, int(soft * 0.8)))
+
+
+def get_nic_irq_cpus() -> Optional[set[int]]:
+    """
+    Finds the CPUs that service the interrupts of the network interface used by the default route.
+    Only works on Linux. Returns None if they cannot be determined.
+    """
+    try:
+        with open("/proc/net/route", "r") as f:
+            routes = [line.split() for line in f.readlines()[1:]]
+        iface = next((route[0] for route in routes if len(route) > 1 and route[1] == "00000000"), None)
+        if iface is None:
+            return None
+
+        cpus = set()
+        with open("/proc/interrupts", "r") as f:
+            for line in f:
+                fields = line.split()
+                # IRQ lines look like "45:  <counts per CPU>  PCI-MSI 524288-edge  eth0-TxRx-0"
+                if len(fields) < 2 or not fields[0].rstrip(":").isdigit():
+                    continue
+                # Match "eth1" and "eth1-TxRx-0", but not another card's "eth10-TxRx-0"
+                if fields[-1] != iface and not fields[-1].startswith(iface + "-"):
+                    continue
+                with open(f"/proc/irq/{fields[0].rstrip(':')}/smp_affinity_list", "r") as irq_file:
+                    for part in irq_file.read().strip().split(","):
+                        first, _, last = part.partition("-")
+                        cpus.update(range(int(first), int(last or first) + 1))
+    except (OSError, ValueError):
+        return None
+
+    return (cpus & os.sched_getaffinity(0)) or None
+
+
 def to_time_str(seconds: int) -> str:
     """Converts seconds to a human-readable time string."""
     hours, remainder = divmod(seconds, 3600)
@@ -131,9 +594,18 @@ def to_time_str(seconds: int) -> str:
         return f"{seconds}s"
 
 
+# Results table lines, formatted once instead of on every redraw.
+# Each row template colors the latency column according to its bucket.
+TABLE_HEADER = f"{Ansi.BOLD}{Ansi.HEADER}{'Rank':<8}{'IP Address':<18}{'Location':<30}{'Latency (ms)':<10}{Ansi.ENDC}"
+TABLE_SEPARATOR = "-" * 70
+TABLE_ROW_GREEN = "{0:<8}{1:<18}{2:<30}" + Ansi.GREEN + "{3:<10}" + Ansi.ENDC
+TABLE_ROW_YELLOW = "{0:<8}{1:<18}{2:<30}" + Ansi.YELLOW + "{3:<10}" + Ansi.ENDC
+TABLE_ROW_RED = "{0:<8}{1:<18}{2:<30}" + Ansi.RED + "{3:<10}" + Ansi.ENDC
+
+
 # Use a static variable inside the function to track its state
 def display_results_table(
-        results: list[dict], tested_count: int, total_count: int,
+        results: list[Result], tested_count: int, total_count: int,
         te: float, etr: float,
         new_results_available: bool, custom_msg: str=None) -> None:
 
@@ -151,19 +623,13 @@ def display_results_table(
 
     # --- Table ---
     if new_results_available:
-        header = f"{Ansi.BOLD}{Ansi.HEADER}{'Rank':<8}{'IP Address':<18}{'Location':<30}{'Latency (ms)':<10}{Ansi.ENDC}"
-        separator = "-" * 70
-        lines_to_print_table.append(header)
-        lines_to_print_table.append(separator)
-
-        for i, res in enumerate(results):
-            rank = i + 1
-            ip = res["ip"]
-            location = res.get("location", "...")
-            latency = f"{res['latency']:.2f}"
-            latency_val = res["latency"]
-            color = Ansi.GREEN if latency_val < 100 else Ansi.YELLOW if latency_val < 200 else Ansi.RED
-            lines_to_print_table.append(f"{rank:<8}{ip:<18}{location:<30}{color}{latency:<10}{Ansi.ENDC}")
+        lines_to_print_table.append(TABLE_HEADER)
+        lines_to_print_table.append(TABLE_SEPARATOR)
+
+        for rank, res in enumerate(results, start=1):
+            latency_val = res.latency
+            row = TABLE_ROW_GREEN if latency_val < 100 else TABLE_ROW_YELLOW if latency_val < 200 else TABLE_ROW_RED
+            lines_to_print_table.append(row.format(rank, res.ip, res.location or "...", f"{latency_val:.2f}"))
 
         display_results_table.num_lines_table = len(lines_to_print_table)
 
@@ -188,14 +654,24 @@ def display_results_table(
     # --- Clear previous output and move the cursor up ---
     # Clear the table only if new results are available
     num_lines_to_clear = (prev_nl_table + prev_nl_progress_bar) if new_results_available else prev_nl_progress_bar
-    output_buffer = (Ansi.CURSOR_UP + Ansi.CLEAR_LINE) * num_lines_to_clear
+    encoding = sys.stdout.encoding or "utf-8"
+    output_buffer = bytearray((Ansi.CURSOR_UP + Ansi.CLEAR_LINE).encode(encoding) * num_lines_to_clear)
 
     # --- Print all lines ---
-    if len(lines_to_print_table) > 0:
-        output_buffer += "\n".join(lines_to_print_table) + "\n"
-    if len(lines_to_print_progress_bar) > 0:
-        output_buffer += "\n".join(lines_to_print_progress_bar) + "\n"
-    print(output_buffer, end="", flush=True)
+    # The whole frame is written to the binary buffer at once, which is a single write() on POSIX.
+    # On a Windows console the buffer still goes through WriteConsoleW, so non-ASCII text is not garbled.
+    for line in lines_to_print_table + lines_to_print_progress_bar:
+        output_buffer += line.encode(encoding, errors="replace")
+        output_buffer += b"\n"
+
+    binary_stdout = getattr(sys.stdout, "buffer", None)
+    if binary_stdout is None:
+        # Not backed by a binary buffer (e.g. redirected to an in-memory text stream)
+        print(output_buffer.decode(encoding), end="", flush=True)
+        return
+    sys.stdout.flush()  # Write out anything printed before this frame first
+    binary_stdout.write(output_buffer)
+    binary_stdout.flush()
 
 
 def main():
@@ -205,7 +681,43 @@ def main():
     parser.add_argument("--limit", type=int, default=20, help="display a limited number of IPs with the lowest latency (default: 20)")
     parser.add_argument("--max-latency", type=int, help="only show IPs with a latency below the specified milliseconds")
     parser.add_argument("--out", type=str, help="save the results to the file")
+    parser.add_argument("--concurrency", type=int, default=100,
+                        help="maximum number of IPs to test at the same time (default: 100)\n"
+                             "higher values scan faster but make the measured latencies less accurate")
+    parser.add_argument("--ipinfo-token", type=str, help="if specified, look up locations in batches with the ipinfo.io batch API")
+    parser.add_argument("--geoip-db", type=str, default="~/.cache/GeoLite2-City.mmdb",
+                        help="local MaxMind GeoLite2-City database used for location lookups if it exists\n"
+                             "(default: ~/.cache/GeoLite2-City.mmdb, falls back to ipinfo.io)")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="split the IPs between this many processes, sharing --concurrency between them (default: 1)")
+    parser.add_argument("--pin-nic-cpus", action="store_true",
+                        help="pin the scan to the CPUs that handle the network card's interrupts (Linux only)")
     args = parser.parse_args()
+    if args.concurrency < 1:
+        parser.error("--concurrency must be at least 1")
+    if args.processes < 1:
+        parser.error("--processes must be at least 1")
+
+    # Every concurrent ping needs a file descriptor
+    concurrency = limit_concurrency(args.concurrency)
+    if concurrency != args.concurrency:
+        print(f"{Ansi.YELLOW}Warning: Changing concurrency to {concurrency} to stay within the open file limit.{Ansi.ENDC}")
+    args.concurrency = concurrency
+    # Every process needs at least one concurrent ping
+    args.processes = min(args.processes, args.concurrency)
+
+    # Keep the scan on the same CPUs as the network card's receive queues to reduce latency jitter
+    if args.pin_nic_cpus:
+        cpus = get_nic_irq_cpus() if hasattr(os, "sched_setaffinity") else None
+        if cpus is None:
+            print(f"{Ansi.YELLOW}Warning: Could not determine the network card's CPUs, not pinning the scan.{Ansi.ENDC}")
+        else:
+            os.sched_setaffinity(0, cpus)
+            print(f"{Ansi.CYAN}Pinned the scan to CPUs {', '.join(map(str, sorted(cpus)))}.{Ansi.ENDC}")
+            # The shard processes inherit the pinning, so they cannot use more CPUs than the network card has
+            if args.processes > len(cpus):
+                print(f"{Ansi.YELLOW}Warning: The {args.processes} processes share {len(cpus)} pinned CPU(s), "
+                      f"so --processes will not scan faster than with {len(cpus)}.{Ansi.ENDC}")
 
     # --- Step 1: Fetch all Cloudflare IPs to test ---
     cidrs = None
@@ -227,104 +739,173 @@ def main():
     print(f"{Ansi.GREEN}Found {total_ips} unique IP addresses to test.{Ansi.ENDC}\n")
 
     # --- Step 2: Fetch all cloudflare IPs ---
+    # All scan state is owned by the event loop thread, so no lock is needed.
+    # Location lookups running on other threads hand their results back to the event loop.
     results = []
     tested_count = 0
     new_results_available = False
-    lock = threading.Lock()
+    te = etr = 0.0
 
-    # Create a small, separate thread pool for location lookups to avoid blocking
+    # Look up locations locally if possible, otherwise use a small, separate thread pool to avoid blocking
+    geoip_reader = open_geoip_db(args.geoip_db)
+    location_cache = open_location_cache("~/.cache/cf-scan-geo.db") if geoip_reader is None else None
     location_executor = ThreadPoolExecutor(max_workers=5)
 
-    def process_location(ip_obj):
-        """Callback to update location asynchronously."""
+    def set_locations(ip_objs, locations):
+        """Stores looked-up locations and caches the successful ones. Must be called on the event loop thread."""
         nonlocal new_results_available
-        location = get_ip_location(ip_obj["ip"])
-        with lock:
-            ip_obj["location"] = location
-            new_results_available = True
-
-    # Time estimation
-    start_time = time.time()
-    prev_time = start_time
-    rate = 0  # seconds/item
-    alpha = 0.95
-
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        future_to_ip = {executor.submit(ping_ip, ip): ip for ip in ips_to_test}
-
-        for future in as_completed(future_to_ip):
-            ip = future_to_ip[future]
-            tested_count += 1
-
+        for ip_obj in ip_objs:
+            ip_obj.location = locations[ip_obj.ip]
+            if location_cache is not None and ip_obj.location != "Network Error":
+                location_cache.set(ip_obj.ip, ip_obj.location)
+        new_results_available = True
+
+    async def process_location(ip_obj):
+        """Looks up the location of an IP on the thread pool."""
+        loop = asyncio.get_running_loop()
+        location = await loop.run_in_executor(location_executor, get_ip_location, ip_obj.ip)
+        set_locations([ip_obj], {ip_obj.ip: location})
+
+    # With an ipinfo.io token, a single thread looks up the queued IPs in batches instead
+    location_queue = queue.Queue()
+
+    def process_location_batches(loop):
+        """Drains the location queue in batches of up to 100 IPs until None is queued."""
+        finished = False
+        while not finished:
+            batch = [location_queue.get()]
+            deadline = time.monotonic() + 0.5
+            while len(batch) < 100 and batch[-1] is not None:
+                try:
+                    batch.append(location_queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            if batch[-1] is None:
+                finished = True
+                batch.pop()
+            if not batch:
+                continue
+
+            # Keep draining the queue even if a batch fails, instead of leaving the remaining IPs without a location
+            ips = [ip_obj.ip for ip_obj in batch]
             try:
-                latency = future.result()
-                if latency is None:
-                    continue
-
-                if args.max_latency is not None and latency >= args.max_latency:
-                    continue
-
-                with lock:
-                    # Check if this new IP can make it into the top list
-                    is_top = len(results) < args.limit or latency < results[args.limit - 1]["latency"]
-
-                    if is_top:
-                        # Fetch its location
-                        ip_obj = {"ip": ip, "latency": latency}
-                        location_executor.submit(process_location, ip_obj)
-
-                        # Add the result to the list
-                        results.append(ip_obj)
-                        results.sort(key=lambda x: x["latency"])
-                        results = results[:args.limit]
-                        new_results_available = True
-
+                locations = get_ip_locations_batch(ips, args.ipinfo_token)
             except Exception:
-                pass
-
-            finally:
-                # Update estimated time
-                new_time = time.time()
-                if tested_count == 1:
-                    rate = new_time - prev_time
+                locations = dict.fromkeys(ips, "Network Error")
+            loop.call_soon_threadsafe(set_locations, batch, locations)
+
+    async def scan():
+        """Pings all IPs on a single event loop and ranks them as they complete."""
+        nonlocal tested_count, new_results_available
+        loop = asyncio.get_running_loop()
+        location_tasks = []
+        top_results = TopResults(args.limit, args.max_latency)
+
+        location_batcher = None
+        if geoip_reader is None and args.ipinfo_token is not None:
+            # A daemon thread, so that an interrupted scan (e.g. Ctrl-C) can exit without the None sentinel
+            location_batcher = threading.Thread(target=process_location_batches, args=(loop,), daemon=True)
+            location_batcher.start()
+
+        # Results are ranked in the order they arrive, as (tested count, [(ip, latency), ...]) batches,
+        # followed by None once pinging has ended
+        result_queue = asyncio.Queue()
+
+        def on_result(ip, latency):
+            result_queue.put_nowait((1, ((ip, latency),)))
+
+        def on_results(tested, ip_latencies):
+            result_queue.put_nowait((tested, ip_latencies))
+
+        if args.processes > 1:
+            pinging = asyncio.create_task(ping_ips_in_processes(
+                ips_to_test, args.processes, args.concurrency, args.limit, args.max_latency, on_results))
+        else:
+            pinging = asyncio.create_task(ping_ips(ips_to_test, args.concurrency, on_result, top_results.worst_allowed))
+        pinging.add_done_callback(lambda _: result_queue.put_nowait(None))
+
+        # The display is redrawn on a timer, so handling a ping result only updates the counters and the heap
+        start_time = time.time()
+        refresh_interval = 0.1  # seconds
+        ranking_finished = False
+
+        async def refresh_display():
+            """Redraws the results table every refresh interval until all ping results are ranked."""
+            nonlocal results, new_results_available, te, etr
+            while True:
+                # Calculate time elapsed (te) and estimated time remaining (etr) from the average rate so far
+                te = time.time() - start_time
+                etr = (total_ips - tested_count) * te / tested_count if tested_count > 0 else 0.0
+
+                is_finished = ranking_finished
+                custom_msg = None
+                if is_finished:
+                    custom_msg = f"{Ansi.YELLOW}Waiting for location lookups to finish...{Ansi.ENDC}"
+
+                if new_results_available:
+                    results = top_results.items()
+                display_results_table(results, tested_count, total_ips, te, etr, new_results_available, custom_msg)
+                new_results_available = False
+
+                if is_finished:
+                    return
+                await asyncio.sleep(refresh_interval)
+
+        refresher = asyncio.create_task(refresh_display())
+
+        # Stop once pinging has ended, even if it failed before every IP was tested
+        while (next_results := await result_queue.get()) is not None:
+            tested, ip_latencies = next_results
+            tested_count += tested
+
+            for ip, latency in ip_latencies:
+                # Check if this new IP can make it into the top list
+                if not top_results.accepts(latency):
+                    continue
+                # Fetch its location. The cache is only used on this thread, since it cannot be shared between threads.
+                ip_obj = Result(ip, latency)
+                if geoip_reader is not None:
+                    ip_obj.location = get_ip_location(ip, geoip_reader)
+                elif location_cache is not None and (cached_location := location_cache.get(ip)) is not None:
+                    ip_obj.location = cached_location
+                elif location_batcher is not None:
+                    location_queue.put(ip_obj)
                 else:
-                    rate = alpha * rate + (1 - alpha) * (new_time - prev_time)
-                prev_time = new_time
-
-                # Calculate time elapsed (te) and estimated time remaining (etr)
-                te = new_time - start_time
-                etr = (total_ips - tested_count) * rate
+                    location_tasks.append(asyncio.create_task(process_location(ip_obj)))
 
-                # Update display every loop
-                with lock:
-                    is_finished = tested_count == total_ips
-                    custom_msg = None
-                    if is_finished:
-                        custom_msg = f"{Ansi.YELLOW}Waiting for location lookups to finish...{Ansi.ENDC}"
+                top_results.add(latency, ip_obj)
+                new_results_available = True
+        ranking_finished = True
 
-                    display_results_table(results, tested_count, total_ips, te, etr, new_results_available, custom_msg)
-                    new_results_available = False
+        # Wait for any outstanding location lookups to finish, and raise the error if pinging failed
+        await asyncio.gather(refresher, pinging, *location_tasks)
+        if location_batcher is not None:
+            location_queue.put(None)
+            await asyncio.to_thread(location_batcher.join)
 
-    # Wait for any outstanding location lookups to finish
+    run_event_loop(scan())
     location_executor.shutdown(wait=True)
+    if geoip_reader is not None:
+        geoip_reader.close()
+    if location_cache is not None:
+        location_cache.close()
 
     # --- Step 3: Final display and save to file ---
-    with lock:
-        custom_msg = f"{Ansi.GREEN}Scanning complete.{Ansi.ENDC}"
-        display_results_table(results, tested_count, total_ips, te, etr, new_results_available, custom_msg)
+    custom_msg = f"{Ansi.GREEN}Scanning complete.{Ansi.ENDC}"
+    display_results_table(results, tested_count, total_ips, te, etr, new_results_available, custom_msg)
 
     if args.out:
         with open(args.out, "w") as f:
             f.write(f"{'Rank':<8}{'IP Address':<18}{'Location':<30}{'Latency (ms)':<10}\n")
-            f.write("-" * 70 + "\n")
+            f.write(TABLE_SEPARATOR + "\n")
             for i, res in enumerate(results):
-                f.write(f"{i + 1:<8}{res['ip']:<18}{res.get('location', 'N/A'):<30}{res['latency']:.2f}\n")
+                f.write(f"{i + 1:<8}{res.ip:<18}{res.location or 'N/A':<30}{res.latency:.2f}\n")
         print(f"{Ansi.GREEN}Results saved to {args.out}{Ansi.ENDC}")
 
 
 def test():
-    print(ping_ip("www.baidu.com"))
-    print(ping_ip("www.google.com"))
+    print(asyncio.run(tcp_ping("www.baidu.com")))
+    print(asyncio.run(tcp_ping("www.google.com")))
 
 
 if __name__ == "__main__":